@@ -2,12 +2,15 @@
 # Licensed under a GPLv3 style license - see LICENSE
 # Core fitting logic extracted from viper.py fit_chunk()
 
+import functools
 import math
+import sys
+
 import numpy as np
 from astropy.io import fits
 
 from read_crires import read_spectrum, read_template, scan_fits_header
-from fts_resample import make_fake_cell
+from fts_resample import make_fake_cell, rebin
 from param import Params, param
 from model import model, IPs, poly, pade, c
 
@@ -19,9 +22,33 @@ def _sanitize(v):
     return v
 
 
+def _num(x):
+    '''Float for JSON, None for None/NaN/Inf.'''
+    return None if x is None or not math.isfinite(x) else float(x)
+
+
 def _safe_list(arr):
     '''Convert numpy array to JSON-safe list.'''
-    return [_sanitize(float(x)) for x in arr]
+    arr = np.asarray(arr, dtype=float)
+    out = arr.tolist()
+    for i in np.flatnonzero(~np.isfinite(arr)):
+        out[i] = None
+    return out
+
+
+@functools.lru_cache(maxsize=32)
+def _vander_pinv(x_bytes, deg):
+    '''Pseudo-inverse of the (column-scaled) Vandermonde matrix of x.'''
+    V = np.vander(np.frombuffer(x_bytes), deg+1, increasing=True)
+    scale = np.sqrt((V*V).sum(axis=0))   # as np.polyfit, for conditioning
+    P = np.linalg.pinv(V/scale) / scale[:, None]
+    P.flags.writeable = False
+    return P
+
+
+def _polyfit(x, y, deg):
+    '''np.polyfit(x, y, deg)[::-1], with the solver reused for the same x.'''
+    return _vander_pinv(np.ascontiguousarray(x, dtype=float).tobytes(), deg) @ y
 
 
 class nameddict(dict):
@@ -81,7 +108,11 @@ def setup_model(obs_path, order, tpl_path=None, atmos_dir='/home/pyodide/atmos',
     # --- preclip upper outliers (cosmics) ---
     i_valid = flag_obs == 0
     if np.any(i_valid):
-        p17, smod, p83 = np.percentile(spec_obs[i_valid], [17, 50, 83])
+        # nearest-rank percentiles from a single partition
+        vals = spec_obs[i_valid]
+        k = (np.multiply([0.17, 0.50, 0.83], len(vals))).astype(int)
+        vals.partition(k)
+        p17, smod, p83 = vals[k]
         sig_est = (p83 - p17) / 2
         flag_obs[spec_obs > smod + 6 * sig_est] |= flag.clip
 
@@ -105,7 +136,8 @@ def setup_model(obs_path, order, tpl_path=None, atmos_dir='/home/pyodide/atmos',
 
     # --- stellar template as interpolation function ---
     if tpl_path:
-        S_star = lambda x: np.interp(x, np.log(wave_tpl) - np.log(1 + berv / c), spec_tpl)
+        lnwave_tpl = np.log(wave_tpl) - np.log(1 + berv / c)
+        S_star = lambda x: np.interp(x, lnwave_tpl, spec_tpl)
     else:
         S_star = lambda x: 0 * x + 1
 
@@ -119,7 +151,7 @@ def setup_model(obs_path, order, tpl_path=None, atmos_dir='/home/pyodide/atmos',
     par.rv = (rv_guess, 0) if not tpl_path else rv_guess
     norm_guess = np.nanmean(spec_obs_ok) / np.nanmean(S_star(np.log(wave_obs_ok))) / np.nanmean(spec_cell_j)
     par.norm = [norm_guess] + [0] * deg_norm
-    par.wave = np.polyfit(pixel_ok - xcen, wave_obs_ok, deg_wave)[::-1]
+    par.wave = _polyfit(pixel_ok - xcen, wave_obs_ok, deg_wave)
     par.ip = [1.5]
 
     if ip_type in ('sg', 'mg', 'asg'):
@@ -210,7 +242,13 @@ def fit_order(setup_result, kapsig=(0, 3), deg_norm=3, deg_wave=3,
     IP_func = S_mod.IP
 
     # --- optional Gaussian prefit for non-Gaussian IP types ---
-    if ip_type in ('sg', 'ag', 'agr', 'bg'):
+    # It only depends on the setup and these arguments, so refits (e.g. with
+    # other clipping) reuse the one stored in setup_result.
+    prefits = setup_result.setdefault('_prefit', {})
+    prefit_key = (ip_type, wgt, par.rv.value)
+    if ip_type in ('sg', 'ag', 'agr', 'bg') and prefit_key in prefits:
+        par = Params(prefits[prefit_key])
+    elif ip_type in ('sg', 'ag', 'agr', 'bg'):
         S_modg = model(S_mod.S_star, S_mod.lnwave_j, S_mod.spec_cell_j,
                        S_mod.fluxes_molec, IPs['g'],
                        xcen=S_mod.xcen, IP_hs=S_mod.IP_hs)
@@ -218,6 +256,7 @@ def fit_order(setup_result, kapsig=(0, 3), deg_norm=3, deg_wave=3,
         try:
             par2, _ = S_modg.fit(pixel_ok, spec_obs_ok, par1, sig=sig[i_ok])
             par = par + par2.flat()
+            prefits[prefit_key] = Params(par)
         except Exception:
             pass
 
@@ -286,13 +325,8 @@ def fit_order(setup_result, kapsig=(0, 3), deg_norm=3, deg_wave=3,
     ip_shape = IP_func(S_mod.vk, *par.ip)
 
     # parameter summary
-    par_summary = {}
-    for k, v in par.flat().items():
-        key_str = str(k)
-        par_summary[key_str] = {
-            'value': _sanitize(float(v.value)),
-            'unc': _sanitize(float(v.unc)) if v.unc is not None else None,
-        }
+    par_summary = {str(k): {'value': _num(v.value), 'unc': _num(v.unc)}
+                   for k, v in par.flat().items()}
 
     return {
         'converged': True,
@@ -313,6 +347,37 @@ def fit_order(setup_result, kapsig=(0, 3), deg_norm=3, deg_wave=3,
     }
 
 
+def _setup_and_fit(obs_path, order, setup_kw, fit_kw):
+    '''Set up and fit one order (module level, so a process pool can pickle it).'''
+    return fit_order(setup_model(obs_path, order, **setup_kw), **fit_kw)
+
+
+def fit_all_orders(obs_path, orders, setup_kw=None, fit_kw=None, max_workers=None):
+    '''
+    Set up and fit each order independently.
+
+    The orders are spread over a process pool. Pyodide has no processes, so
+    there they run one after another.
+
+    Parameters
+    ----------
+    setup_kw, fit_kw : dict
+        Keyword arguments for setup_model and fit_order.
+
+    Returns a dict with the fit_order result for each order (keyed by str(order)).
+    '''
+    args = [(obs_path, o, setup_kw or {}, fit_kw or {}) for o in orders]
+    if sys.platform == 'emscripten' or len(args) < 2:
+        results = [_setup_and_fit(*a) for a in args]
+    else:
+        # imported here: concurrent.futures.process needs _multiprocessing,
+        # which Pyodide does not build
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers) as pool:
+            results = list(pool.map(_setup_and_fit, *zip(*args)))
+    return {str(o): r for o, r in zip(orders, results)}
+
+
 def _load_atmosphere(lnwave_j, lmin, lmax, wave_obs, atmos_dir,
                      molecules=None, tellshift=False):
     '''
@@ -351,31 +416,35 @@ def _load_atmosphere(lnwave_j, lmin, lmax, wave_obs, atmos_dir,
 
             for mol in molec_sel:
                 if mol != 'lambda' and mol in cols:
-                    specs_molec_all[mol].extend(data[mol])
-                    wave_atm_all[mol].extend(data['lambda'] * (1 + (-0.249 / 3e5)))
+                    specs_molec_all[mol].append(data[mol].copy())
+                    wave_atm_all[mol].append(data['lambda'] * (1 + (-0.249 / 3e5)))
 
             hdu.close()
         except Exception as e:
             print(f'Warning: could not load atmosphere band {band}: {e}')
 
     molec_list = list(specs_molec_all.keys())
-    specs_molec = np.zeros((0, len(lnwave_j)))
+    # molecules not covered by the atmosphere tables stay at unity
+    specs_molec = np.ones((len(molec_list), len(lnwave_j)))
     par_atm = []
 
-    for mol in molec_list:
-        s_mol = slice(*np.searchsorted(wave_atm_all[mol], [lmin, lmax]))
-        wave_mol = np.array(wave_atm_all[mol])
-        spec_mol_raw = np.array(specs_molec_all[mol])
-
-        if len(spec_mol_raw[s_mol]) > 0:
-            spec_mol = np.interp(lnwave_j, np.log(wave_mol[s_mol]), spec_mol_raw[s_mol])
-            specs_molec = np.r_[specs_molec, [spec_mol]]
+    for m, mol in enumerate(molec_list):
+        wave_mol = np.concatenate(wave_atm_all[mol])
+        spec_mol_raw = np.concatenate(specs_molec_all[mol])
+        # the samples bracketing the outer bin edges of lnwave_j (as in rebin),
+        # plus one spare sample each side
+        dx = lnwave_j[1] - lnwave_j[0]
+        i0, i1 = np.searchsorted(wave_mol, np.exp([lnwave_j[0]-dx/2, lnwave_j[-1]+dx/2]))
+        s_mol = slice(max(i0-1, 0), i1+2)
+
+        if len(spec_mol_raw[s_mol]) > 1:
+            spec_mol = rebin(lnwave_j, np.log(wave_mol[s_mol]), spec_mol_raw[s_mol])
+            specs_molec[m] = spec_mol
             if np.nanstd(spec_mol) > 0.0001:
                 par_atm.append((1, np.inf))
             else:
                 par_atm.append((np.nan, 0))
         else:
-            specs_molec = np.r_[specs_molec, [lnwave_j * 0 + 1]]
             par_atm.append((np.nan, 0))
 
     if tellshift and len(molec_list) > 0:
@@ -463,18 +532,57 @@ def _fit_multi(par, orders, models, pixels_all, specs_all, sigs_all, npix):
     varykeys, varyvals = zip(*par.vary().items())
     npar = len(varyvals)
 
+    last = {}
+
     def multi_model(x_unused, *params):
         pnew = par + dict(zip(varykeys, params))
         out = np.empty(len(pixel_cat))
         for i, o in enumerate(orders):
             out[boundaries[i]:boundaries[i + 1]] = \
                 models[i](pixels_all[i], **_order_par(pnew, o))
+        last['params'], last['out'] = params, out
         return out
 
+    # Jacobian sparsity: a per-order parameter (e.g. ('norm_o5', 0)) only
+    # moves the pixels of its order, shared ones (rv, atm) move all pixels.
+    rows = []
+    groups = {}
+    for j, k in enumerate(varykeys):
+        name, idx = k if isinstance(k, tuple) else (k, None)
+        rows.append(slice(None))
+        for i, o in enumerate(orders):
+            if name.endswith(f'_o{o}'):
+                rows[j] = slice(boundaries[i], boundaries[i + 1])
+                name = name[:-len(f'_o{o}')]
+                break
+        else:
+            name = j   # shared: own group
+        groups.setdefault((name, idx), []).append(j)
+
+    def multi_jac(x_unused, *params):
+        # forward differences as MINPACK with epsfcn=1e-12, but the columns
+        # of one group have disjoint rows and share one model evaluation.
+        # LM has just evaluated the model at params, so reuse that.
+        f0 = last['out'] if last.get('params') == params else multi_model(x_unused, *params)
+        params = np.array(params)
+        jac = np.zeros((len(pixel_cat), npar))
+        for cols in groups.values():
+            h = 1e-6 * np.abs(params[cols])
+            h[h == 0] = 1e-6
+            p = params.copy()
+            p[cols] += h
+            df = multi_model(x_unused, *p) - f0
+            for j, hj in zip(cols, h):
+                jac[rows[j], j] = df[rows[j]] / hj
+        return jac
+
+    # with jac given, MINPACK (lmder) counts only model calls in maxfev,
+    # about one per iteration; 800 keeps the ~800 iterations that
+    # 800*(npar+1) allowed with the finite-difference lmdif
     try:
         popt, pcov = curve_fit(multi_model, pixel_cat, spec_cat, p0=varyvals,
-                               sigma=sig_cat, absolute_sigma=False, epsfcn=1e-12,
-                               maxfev=800 * (npar + 1))
+                               sigma=sig_cat, absolute_sigma=False, jac=multi_jac,
+                               maxfev=800)
     except Exception as e:
         return False, str(e)
 
@@ -630,13 +738,8 @@ def fit_multi_order(setup_result, kapsig=(0, 3), deg_norm=3, deg_wave=3,
         }
 
     # parameter summary
-    par_summary = {}
-    for k, v in par_fit.flat().items():
-        key_str = str(k)
-        par_summary[key_str] = {
-            'value': _sanitize(float(v.value)),
-            'unc': _sanitize(float(v.unc)) if v.unc is not None else None,
-        }
+    par_summary = {str(k): {'value': _num(v.value), 'unc': _num(v.unc)}
+                   for k, v in par_fit.flat().items()}
 
     IP_func = models[0].IP
     ip_shape = IP_func(models[0].vk, *par_fit[f'ip_o{orders[0]}'])
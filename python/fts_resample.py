@@ -53,6 +53,35 @@ def resample(w, f, dv=100):
     return w, f, uj, iod_j
 
 
+def rebin(uj, u, f, fill=1.):
+    '''
+    Flux-conserving resampling of f(u) onto the grid uj (SpectRes-like).
+
+    The linear interpolant of f is integrated exactly over each output bin
+    (edges halfway between the uj). Bins not covered by u are set to fill.
+    Segments next to non-finite samples are left out of both the integral
+    and the bin width; bins covered only by such segments become NaN.
+    '''
+    ok = np.isfinite(f)
+    f = np.where(ok, f, 0.)
+    h = np.diff(u)
+    g = h * (ok[1:] & ok[:-1])   # segment lengths that count
+    F = np.r_[0, np.cumsum(g * (f[1:]+f[:-1]) / 2)]
+    ue = np.r_[1.5*uj[0]-0.5*uj[1], (uj[1:]+uj[:-1])/2, 1.5*uj[-1]-0.5*uj[-2]]
+    k = np.clip(np.searchsorted(u, ue) - 1, 0, len(u)-2)
+    t = (ue-u[k]) / h[k]
+    F_e = F[k] + g[k] * t * (f[k] + t/2*(f[k+1]-f[k]))
+    if ok.all():
+        w_j = np.diff(ue)
+    else:
+        w_j = np.diff(np.r_[0, np.cumsum(g)][k] + g[k]*t)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        f_j = np.diff(F_e) / w_j
+    f_j[w_j == 0] = np.nan
+    f_j[(ue[:-1] < u[0]) | (ue[1:] > u[-1])] = fill
+    return f_j
+
+
 def make_fake_cell(wave_min, wave_max, npix, dv=200):
     '''
     Create a flat unity spectrum in log-wavelength space.
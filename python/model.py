@@ -4,6 +4,7 @@
 
 import numpy as np
 from scipy.optimize import curve_fit
+from scipy.signal import oaconvolve
 from scipy.special import erf
 
 c = 299792.458   # [km/s] speed of light
@@ -96,6 +97,16 @@ def IP_lor(vk, s=2.2):
 IPs = {'g': IP, 'sg': IP_sg, 'sbg': IP_sbg, 'ag': IP_ag, 'agr': IP_agr, 'asg': IP_asg, 'bg': IP_bg, 'mg': IP_mg, 'mcg': IP_mcg, 'lor': IP_lor}
 
 
+def convolve(IP_k, S_j):
+    '''
+    Valid-mode convolution. The direct sum is faster for the usual kernel
+    sizes (IP_hs=50); overlap-add FFT only wins for long kernels.
+    '''
+    if len(IP_k) > 256:
+        return oaconvolve(S_j, IP_k, mode='valid')
+    return np.convolve(IP_k, S_j, mode='valid')
+
+
 def poly(x, a):
     return np.polyval(a[::-1], x)
 
@@ -120,36 +131,116 @@ class model:
         self.vk = np.arange(-IP_hs, IP_hs+1) * self.dx * c
         self.lnwave_j_eff = self.lnwave_j[IP_hs:-IP_hs]
         self.func_norm = func_norm
-
-    def __call__(self, pixel, rv=0, norm=[1], wave=[], ip=[], atm=[], bkg=[0], ipB=[]):
+        self._S_star_rv = None
+        self._IP_coeff = None
+        self._memos = {}
+        # nocell mode passes a unity cell, which need not be multiplied in
+        self._cell_flat = np.all(self.spec_cell_j == 1)
+        # telluric product in log space; NaNs (skipped by nanprod) become log(1)
+        self._log_fluxes_molec = np.nan_to_num(np.log(np.clip(self.fluxes_molec, 1e-30, None)))
+
+    def S_star_j(self, rv):
+        '''Stellar template on lnwave_j, reused while rv does not change.'''
+        if rv != self._S_star_rv:
+            self._S_star_j = self.S_star(self.lnwave_j-rv/c)
+            self._S_star_rv = rv
+        return self._S_star_j
+
+    def _memo(self, name, pixel, coeff, func):
+        '''func(), reused while pixel (the same array) and coeff do not change.'''
+        coeff = tuple(coeff)
+        hit = self._memos.get(name)
+        if hit is None or hit[0] is not pixel or hit[1] != coeff:
+            hit = self._memos[name] = pixel, coeff, func()
+        return hit[2]
+
+    def _interp_at(self, lnwave_obs):
+        '''
+        Left grid index and weight for linear interpolation on the uniform
+        grid lnwave_j_eff, clamped at the ends like np.interp. A NaN
+        lnwave_obs (wavelength <= 0) gets index 0 and a NaN weight, so the
+        interpolated value is NaN there, as from np.interp.
+        '''
+        lnw = self.lnwave_j_eff
+        n = len(lnw)
+        u = np.clip((lnwave_obs-lnw[0]) * ((n-1)/(lnw[-1]-lnw[0])), 0, n-1)
+        i = np.minimum(np.nan_to_num(u).astype(int), n-2)
+        inside = (lnw[0] <= lnwave_obs) & (lnwave_obs <= lnw[-1])
+        return i, u-i, inside
+
+    def IP_k(self, coeff_ip):
+        '''IP kernel on vk, reused while the IP coefficients do not change.'''
+        coeff_ip = tuple(coeff_ip)
+        if coeff_ip != self._IP_coeff:
+            self._IP_k = self.IP(self.vk, *coeff_ip)
+            self._IP_coeff = coeff_ip
+        return self._IP_k
+
+    def __call__(self, pixel, rv=0, norm=[1], wave=[], ip=[], atm=[], bkg=[0], ipB=[], jac_keys=None):
+        '''
+        Model at pixel. With jac_keys (parameter keys like ('norm', 0)), also
+        return a dict with the analytic derivatives for those of them that
+        have one (norm for func_norm=poly, wave, bkg).
+        '''
         coeff_norm, coeff_wave, coeff_ip, coeff_atm, coeff_bkg, coeff_ipB = norm, wave, ip, atm, bkg, ipB
 
-        spec_gas = 1 * self.spec_cell_j
+        spec_gas = self.spec_cell_j
 
         if len(self.fluxes_molec):
-            flux_atm = np.nanprod(np.power(self.fluxes_molec, np.abs(coeff_atm[:len(self.fluxes_molec)])[:, np.newaxis]), axis=0)
+            flux_atm = np.exp(np.nan_to_num(np.abs(coeff_atm[:len(self.fluxes_molec)])) @ self._log_fluxes_molec)
 
             if len(coeff_atm) == len(self.fluxes_molec)+1:
                 flux_atm = np.interp(self.lnwave_j, self.lnwave_j-np.log(1+coeff_atm[-1]/c), flux_atm)
 
-            spec_gas *= flux_atm
+            spec_gas = flux_atm if self._cell_flat else spec_gas * flux_atm
 
-        Sj_eff = np.convolve(self.IP(self.vk, *coeff_ip), self.S_star(self.lnwave_j-rv/c) * (spec_gas + coeff_bkg[0]), mode='valid')
+        IP_k = self.IP_k(coeff_ip)
+        conv = lambda Sj: convolve(IP_k, Sj)
 
         if len(coeff_ipB):
             coeff_ipB = [coeff_ipB[0]*coeff_ip[0], *coeff_ip[1:]]
-            Sj_B = np.convolve(self.IP(self.vk, *coeff_ipB), self.S_star(self.lnwave_j-rv/c) * (spec_gas + coeff_bkg[0]), mode='valid')
-            Sj_A = Sj_eff
+            IP_B = self.IP(self.vk, *coeff_ipB)
             g = self.lnwave_j_eff - self.lnwave_j_eff[0]
             g /= g[-1]
-            Sj_eff = (1-g)*Sj_A + g*Sj_B
-
-        lnwave_obs = np.log(poly(pixel-self.xcen, coeff_wave))
-
-        Si_eff = np.interp(lnwave_obs, self.lnwave_j_eff, Sj_eff)
-
-        Si_mod = self.func_norm(pixel-self.xcen, coeff_norm) * Si_eff
-        return Si_mod
+            conv = lambda Sj: (1-g)*convolve(IP_k, Sj) + g*convolve(IP_B, Sj)
+
+        # stellar template and gas cell are shared by both IP convolutions
+        S_star_j = self.S_star_j(rv)
+        Sj = spec_gas + coeff_bkg[0]
+        Sj *= S_star_j
+        Sj_eff = conv(Sj)
+
+        # pixel is fixed during a fit, and the rv, ip and atm steps of the
+        # jacobian leave wavelength solution and normalisation unchanged
+        x = self._memo('x', pixel, (), lambda: pixel - self.xcen)
+        wave_obs = self._memo('wave', pixel, coeff_wave, lambda: poly(x, coeff_wave))
+        lnwave_obs = self._memo('lnwave', pixel, coeff_wave, lambda: np.log(wave_obs))
+
+        i, w, inside = self._memo('interp', pixel, coeff_wave, lambda: self._interp_at(lnwave_obs))
+        interp = lambda S_j: S_j[i]*(1-w) + S_j[i+1]*w
+        Si_eff = interp(Sj_eff)
+
+        func_norm = self._memo('norm', pixel, coeff_norm, lambda: self.func_norm(x, coeff_norm))
+        Si_mod = func_norm * Si_eff
+        if jac_keys is None:
+            return Si_mod
+
+        jac = {}
+        if ('bkg', 0) in jac_keys:
+            jac['bkg', 0] = func_norm * interp(conv(S_star_j))
+        if self.func_norm is poly:
+            for k in range(len(coeff_norm)):
+                if ('norm', k) in jac_keys:
+                    jac['norm', k] = x**k * Si_eff
+        if any(('wave', k) in jac_keys for k in range(len(coeff_wave))):
+            # slope of the interpolated segment; zero where it clamped
+            lnw = self.lnwave_j_eff
+            dSi = (Sj_eff[i+1]-Sj_eff[i]) / (lnw[i+1]-lnw[i]) * inside
+            for k in range(len(coeff_wave)):
+                if ('wave', k) in jac_keys:
+                    jac['wave', k] = func_norm * dSi * x**k / wave_obs
+
+        return Si_mod, jac
 
     def fit(self, pixel, spec_obs, par, sig=[], **kwargs):
         '''
@@ -159,7 +250,22 @@ class model:
 
         S_model = lambda x, *params: self(x, **(par + dict(zip(varykeys, params))))
 
-        params, e_params = curve_fit(S_model, pixel, spec_obs, p0=varyvals, sigma=sig, absolute_sigma=False, epsfcn=1e-12)
+        def S_jac(x, *params):
+            # analytic columns where the model has them, the others by forward
+            # differences with the step MINPACK uses for epsfcn=1e-12
+            f0, dfdp = self(x, **(par + dict(zip(varykeys, params))), jac_keys=varykeys)
+            jac = np.empty((len(x), len(params)))
+            for j, k in enumerate(varykeys):
+                if k in dfdp:
+                    jac[:, j] = dfdp[k]
+                else:
+                    h = 1e-6 * abs(params[j]) or 1e-6
+                    jac[:, j] = (S_model(x, *params[:j], params[j]+h, *params[j+1:]) - f0) / h
+            return jac
+
+        # with jac, maxfev counts only model calls (about one per iteration);
+        # 200 keeps the ~200 iterations of lmdif's default 200*(n+1)
+        params, e_params = curve_fit(S_model, pixel, spec_obs, p0=varyvals, sigma=sig, absolute_sigma=False, jac=S_jac, maxfev=200)
 
         pnew = par + dict(zip(varykeys, params))
         for k, v in zip(varykeys, np.sqrt(np.diag(e_params))):
@@ -2,27 +2,67 @@
 # Licensed under a GPLv3 style license - see LICENSE
 # Simplified from inst/inst_CRIRES.py: astropy-only, no coordinates/SkyCoord
 
+import functools
+import os
+import re
+
 import numpy as np
 from astropy.io import fits
 from astropy.time import Time
 
 
+_SPEC_COL = re.compile(r'(\d+)_([^_]+)_SPEC')
+
+
 def _get_drs_columns(hdu, detector):
     '''Get sorted DRS order numbers and their column prefixes from a detector extension.'''
     cols = hdu[detector].columns.names
-    spec_cols = [col for col in cols if col.endswith('_SPEC')]
     # extract unique (order_drs, trace) pairs
     prefixes = {}
-    for col in spec_cols:
-        parts = col.split('_')
-        odrs = int(parts[0])
-        trace = parts[1]
-        if odrs not in prefixes:
-            prefixes[odrs] = f'{parts[0]}_{trace}'
+    for col in cols:
+        m = _SPEC_COL.fullmatch(col)
+        if m and int(m[1]) not in prefixes:
+            prefixes[int(m[1])] = f'{m[1]}_{m[2]}'
     # sort descending so index 0 = highest DRS order = lowest VIPER order_idx
     return sorted(prefixes.items(), reverse=True)
 
 
+@functools.lru_cache(maxsize=8)
+def _read_fits(filename, mtime, size):
+    '''
+    Read the primary header and the columns of every order in one pass.
+
+    Returns
+    -------
+    hdr, orders
+        orders maps detector -> list (sorted as _get_drs_columns) of dicts
+        {column suffix: array}, e.g. {'SPEC': ..., 'ERR': ..., 'WL': ...}.
+    '''
+    hdu = fits.open(filename, ignore_blank=True)
+    hdr = hdu[0].header.copy()
+
+    orders = {}
+    for det in (1, 2, 3):
+        try:
+            drs_cols = _get_drs_columns(hdu, det)
+        except:
+            continue
+        cols = hdu[det].columns.names
+        data = hdu[det].data
+        orders[det] = [{col[len(prefix)+1:]: data[col].copy() for col in cols if col.startswith(prefix+'_')}
+                       for _, prefix in drs_cols]
+
+    hdu.close()
+
+    return hdr, orders
+
+
+def _open(filename):
+    '''Cached file content, keyed by path and modification so new uploads are reread.'''
+    st = os.stat(filename)
+    return _read_fits(filename, st.st_mtime_ns, st.st_size)
+
+
 def read_spectrum(filename, order):
     '''
     Read a CRIRES observation spectrum.
@@ -41,8 +81,7 @@ def read_spectrum(filename, order):
     order_idx, detector = divmod(order - 1, 3)
     detector += 1
 
-    hdu = fits.open(filename, ignore_blank=True)
-    hdr = hdu[0].header
+    hdr, orders = _open(filename)
 
     nod_type = hdr.get('ESO PRO CATG', '')
 
@@ -55,18 +94,15 @@ def read_spectrum(filename, order):
 
     berv = hdr.get('ESO QC BERV', 0.0)
 
-    drs_cols = _get_drs_columns(hdu, detector)
-    prefix = drs_cols[order_idx][1]
+    data = orders[detector][order_idx]
 
-    spec = hdu[detector].data[f"{prefix}_SPEC"].copy()
-    err = hdu[detector].data[f"{prefix}_ERR"].copy()
-    wave = hdu[detector].data[f"{prefix}_WL"].copy() * 10  # nm -> Angstrom
+    spec = data["SPEC"].copy()
+    err = data["ERR"].copy()
+    wave = data["WL"] * 10  # nm -> Angstrom
 
     pixel = np.arange(spec.size)
     flag_pixel = 1 * np.isnan(spec)
 
-    hdu.close()
-
     return pixel, wave, spec, err, flag_pixel, berv, dateobs
 
 
@@ -88,19 +124,15 @@ def read_template(filename, order):
     order_idx, detector = divmod(order - 1, 3)
     detector += 1
 
-    hdu = fits.open(filename, ignore_blank=True)
-
-    drs_cols = _get_drs_columns(hdu, detector)
-    prefix = drs_cols[order_idx][1]
+    _, orders = _open(filename)
+    data = orders[detector][order_idx]
 
-    spec = hdu[detector].data[f"{prefix}_SPEC"].copy()
-    wave = hdu[detector].data[f"{prefix}_WL"].copy()
+    spec = data["SPEC"].copy()
+    wave = data["WL"].copy()
 
     if not filename.endswith('_tpl.fits'):
         wave = wave * 10  # nm -> Angstrom
 
-    hdu.close()
-
     return wave, spec
 
 
@@ -112,8 +144,7 @@ def scan_fits_header(filename):
     -------
     dict with keys: berv, dateobs, setting, n_orders, available_orders
     '''
-    hdu = fits.open(filename, ignore_blank=True)
-    hdr = hdu[0].header
+    hdr, orders = _open(filename)
 
     setting = hdr.get('ESO INS WLEN ID', 'unknown')
     berv = hdr.get('ESO QC BERV', 0.0)
@@ -127,16 +158,10 @@ def scan_fits_header(filename):
         dateobs = hdr.get('DATE-OBS', '')
 
     available_orders = []
-    for det in (1, 2, 3):
-        try:
-            drs_cols = _get_drs_columns(hdu, det)
-            for idx in range(len(drs_cols)):
-                order = idx * 3 + det
-                available_orders.append(order)
-        except:
-            pass
-
-    hdu.close()
+    for det, det_orders in orders.items():
+        for idx in range(len(det_orders)):
+            order = idx * 3 + det
+            available_orders.append(order)
 
     return {
         'berv': berv,
@@ -2,11 +2,17 @@
 # from https://github.com/mzechmeister/python
 
 from __future__ import print_function
+import functools
+import math
 import sys
 
 import numpy as np
 
-einsum_bug = tuple(map(int, np.__version__.split(".")[:2])) < (1, 7)
+@functools.lru_cache(maxsize=64)
+def _subs(ndim, dim, nops=1):
+   # einsum subscripts summing nops operands of ndim axes over all but dim
+   ij = 'abcdefghijklmnopqrstuvwxyz'[:ndim]
+   return ','.join([ij]*nops) + '->' + ''.join(ij[a] for a in dim)
 
 def wmom(y, w=None, moment=1, axis=None, e=None, dim=(), keepdims=False):
    y = np.array(y, dtype=float)
@@ -20,15 +26,20 @@ def wmom(y, w=None, moment=1, axis=None, e=None, dim=(), keepdims=False):
       if isinstance(dim, int): dim = (dim,)
       dim = [d[a] for a in dim]
 
-   if w is None:
-      w = np.ones_like(y) if e is None else 1./e**2
+   if w is None and e is not None:
+      w = 1./(e*e)
 
    scalar = isinstance(moment, int)
    if scalar: moment = [moment]
-   if einsum_bug and dim:
-      m = [np.einsum(w, d, y**i, d, dim) for i in moment]
+   dim = tuple(dim)
+   if w is None:
+      # unweighted: no array of ones, and the zeroth moment is a count
+      shape = [y.shape[a] for a in dim]
+      n = float(y.size // max(math.prod(shape), 1))
+      m = [np.einsum(_subs(y.ndim, dim, i), *(y,)*i) if i else np.full(shape, n)[()]
+           for i in moment]
    else:
-      m = [np.einsum(w, d, *(y,d)*i+(dim,)) for i in moment]
+      m = [np.einsum(_subs(y.ndim, dim, i+1), w, *(y,)*i) for i in moment]
 
    if keepdims:
       kdim = [(ni if i in dim else 1) for i,ni in enumerate(y.shape)]
@@ -41,6 +52,8 @@ def wmean(y, w=None, axis=None, dim=None):
       return np.mean(y, axis=axis)
 
    if dim is None and axis is None:
+      if w.ndim == y.ndim == 1:
+         return np.dot(w, y) / w.sum()
       wysum = np.dot(w.ravel(), y.ravel())
       wsum = float(w.sum())
    else:
@@ -54,14 +67,24 @@ def wmean(y, w=None, axis=None, dim=None):
          dim = [d[a] for a in dim]
 
       if w is None:
-         wysum = np.einsum(y, d, dim)
+         wysum = np.einsum(_subs(y.ndim, tuple(dim)), y)
          wsum = float(y.size / wysum.size)
       else:
-         wysum = np.einsum(w, d, y, d, dim)
-         wsum = np.einsum(w, d, dim).astype(float)
+         dim = tuple(dim)
+         wysum = np.einsum(_subs(y.ndim, dim, 2), w, y)
+         wsum = np.einsum(_subs(y.ndim, dim), w, dtype=float)
 
    return wysum / wsum
 
+def _wsqdev(y, mean, wy, **kwargs):
+   # sum w*(y-mean)^2 as sum w*y^2 - mean*sum w*y, without the y-mean copy;
+   # the two-pass sum is kept where the mean dominates and this would cancel
+   wyy = wmom(y, moment=2, **kwargs)
+   ss = wyy - mean*wy
+   if np.all(ss > 1e-6*wyy):
+      return ss
+   return wmom(y-mean, moment=2, **kwargs)
+
 def wsem(y, mean=None, rescale=True, ddof=1, keepdims=False, **kwargs):
    kwargs['keepdims'] = keepdims or kwargs.get('dim') or kwargs.get('axis')
 
@@ -73,7 +96,7 @@ def wsem(y, mean=None, rescale=True, ddof=1, keepdims=False, **kwargs):
       dof = float(y.size / mean.size)
       if dof > 1:
          if ddof: dof -= ddof
-         var_mean = var_mean * wmom(y-mean, moment=2, **kwargs) / dof
+         var_mean = var_mean * _wsqdev(y, mean, wy, **kwargs) / dof
 
    if kwargs['keepdims'] and not keepdims:
       mean = mean.squeeze()
@@ -83,18 +106,18 @@ def wsem(y, mean=None, rescale=True, ddof=1, keepdims=False, **kwargs):
 
 
 def wrms(y, w=None):
-   W, quadsum = (len(y), np.dot(y,y)) if w is None else (
-                 np.sum(w), np.einsum('i,i,i', w,y,y))
+   if w is None:
+      W, quadsum = len(y), np.dot(y,y)
+   else:
+      # BLAS ddot is faster while the y*y temporary fits in cache (orders
+      # of a few 1e4 pixels), the fused einsum pass beyond that
+      W, quadsum = np.sum(w), (np.dot(w, np.square(y)) if len(y) < 100000 else
+                               np.einsum('i,i,i', w,y,y))
    return np.sqrt(quadsum/W)
 
 quadmean = rms = wrms
 
 def wstd(y, e, axis=None, dim=(), ret_err=False):
-   w = np.zeros_like(e, dtype=float)
-   with np.errstate(invalid='ignore'):
-       ind = e > 0
-   w[ind] = 1. / e[ind]**2
-
    d = range(y.ndim)
    if axis is not None:
       if isinstance(axis, int): axis = (axis,)
@@ -107,16 +130,25 @@ def wstd(y, e, axis=None, dim=(), ret_err=False):
       dim = [d[a] for a in dim]
       s = tuple(slice(None) if (a in dim) else None for a in d)
 
-   with np.errstate(divide='ignore'):
-      nsum = np.einsum(ind.astype(float), d, dim)
-      wsum = np.einsum(w, d, dim).astype(float)
-      wmean =  np.einsum(w, d, y, d, dim) / wsum
+   # for NaN errors, and the 0/0 of slices without any valid point
+   with np.errstate(invalid='ignore', divide='ignore'):
+      ind = e > 0
+      # 1/e^2, and 1/inf = 0 where e <= 0
+      w = np.multiply(e, e, dtype=float)
+      w[~ind] = np.inf
+      np.divide(1., w, out=w)
+
+      sub1, sub2 = _subs(y.ndim, tuple(dim)), _subs(y.ndim, tuple(dim), 2)
+      wsum = np.einsum(sub1, w)
+      wmean =  np.einsum(sub2, w, y) / wsum
       res = y - (wmean[s] if s else wmean)
-      wstd1 = (np.einsum(w, d, res*res, d, dim) / wsum)**.5
+      wstd1 = (np.einsum(sub2, w, res*res) / wsum)**.5
       out = (wstd1, wmean)
 
-   if ret_err:
-      out += ((nsum/wsum)**.5,)
+      if ret_err:
+         # number of valid points, only needed for the error
+         nsum = np.count_nonzero(ind, axis=tuple(a for a in d if a not in dim))
+         out += ((nsum/wsum)**.5,)
 
    return out
 
@@ -127,9 +159,9 @@ def wstd_new(y, mean=None, ddof=1, keepdims=False, **kwargs):
    mean = wy / wsum
    var_mean = 1. / wsum
 
-   dof = wmom(y, moment=0, **kwargs)
+   dof = wsum
    if dof > 1:
-      var_mean = var_mean * wmom(y-mean, moment=2, **kwargs) * dof / (dof-ddof)
+      var_mean = var_mean * _wsqdev(y, mean, wy, **kwargs) * dof / (dof-ddof)
 
    if kwargs['keepdims'] and not keepdims:
       mean = mean.squeeze()
@@ -139,17 +171,17 @@ def wstd_new(y, mean=None, ddof=1, keepdims=False, **kwargs):
 
 
 def wnan_to_num(y, w=None, e=None):
-   if w is None:
-      if e is not None:
-         w = np.zeros(y.shape)
-         ind = e > 0
-         w[ind] = 1. / e[ind]**2
+   ok = np.isfinite(y)
+   if w is not None:
+      w = np.nan_to_num(w) * ok
+   elif e is not None:
+      # 1/e^2 where e > 0 and y is finite, else 1/inf = 0, in place
+      w = np.multiply(e, e, dtype=float)
+      w[~(ok & (e > 0))] = np.inf
+      np.divide(1., w, out=w)
    else:
-      w = np.nan_to_num(w)
-
-   w = np.isfinite(y) * (1. if w is None else w)
-   y = np.nan_to_num(y)
-   return y, w
+      w = ok * 1.
+   return np.nan_to_num(y), w
 
 def nanwsem(y, w=None, e=None, **kwargs):
    y, w = wnan_to_num(y, w=w, e=e)
@@ -164,14 +196,24 @@ def naniqr(x, w=None, e=None, **kwargs):
    return iqr(x, w=w, **kwargs)
 
 def quantile(x, p, w=None, middle=False):
-   ii = np.argsort(x)
-
    if w is None:
-      i = np.multiply(p, len(x)).astype(int)
-   else:
-      cdf = np.cumsum(w[ii])
-      cdf = cdf / float(cdf[-1])
-      i = np.searchsorted(cdf, p, side='right')
+      i = np.multiply(p, len(x)).astype(int).clip(0, len(x)-1)
+      k = np.unique(i)
+      if len(k) > 4:
+         return np.sort(x)[i]
+      # order statistics by selection, from the top down so that each
+      # partition only works on the part below the previous one
+      x = np.array(x)
+      n = len(x)
+      for kk in k[::-1]:
+         x[:n].partition(kk)
+         n = kk
+      return x[i]
+
+   ii = np.argsort(x)
+   cdf = np.cumsum(w[ii])
+   # scale p to the total weight rather than normalising the whole cdf
+   i = np.searchsorted(cdf, np.multiply(p, cdf[-1]), side='right')
    scalar = np.isscalar(i)
    if scalar: i = [i]
 
@@ -189,7 +231,9 @@ def iqr(x, w=None, sigma=False):
    return iqr
 
 def mad(data, axis=None, sigma=False):
-   mad = np.median(np.absolute(data - np.median(data, axis)), axis)
+   # one deviation array, made absolute in place and reused by the median
+   dev = np.asarray(data - np.median(data, axis, keepdims=True))
+   mad = np.median(np.absolute(dev, out=dev), axis, overwrite_input=True)
    if sigma:
       mad *= 1.4826
    return mad
@@ -198,26 +242,31 @@ def mlrms(y, e, s=0., verbose=False, ml=True, ret_mean=False):
    n = y.size
    i = 0
    eps = .000001
+   ee = e * e
    while True:
       i += 1
-      w = 1 / (e**2+s**2)
+      w = 1 / (ee+s*s)
       W = w.sum()
-      q = 1 / np.sqrt(w.mean())
+      q = 1 / np.sqrt(W/n)
       Y = np.dot(w, y) / W
       r = y - Y
+      r2 = r * r
 
-      chi2 = np.sum(w*r**2)
+      # weighted sums as dot products, without w*r2 temporaries
+      chi2 = np.dot(w, r2)
       wrms = np.sqrt(chi2 / W)
       if ml:
-         wwrr = np.sum(w*w*r**2)
-         s = np.sqrt((np.sum(w*w*(r**2-e**2)) / np.sum(w*w)).clip(min=0))
+         ww = w * w
+         wwrr = np.dot(ww, r2)
+         s = np.sqrt(((wwrr-np.dot(ww, ee)) / np.dot(w, w)).clip(min=0))
          rr = wwrr / W
       else:
-         s = np.sqrt((s**2+wrms**2-q**2).clip(min=0))
+         s = np.sqrt((s*s+wrms*wrms-q*q).clip(min=0))
          rr = wrms / q
-      lnL = -0.5 * np.sum(np.log(2*np.pi/w)) - 0.5 * chi2
 
-      if verbose: print('mean %.5g' %Y,' err', q, ' mlrms', wrms, lnL, ' rchi', chi2/n, rr, ' jit', s, s/wrms, wwrr,W)
+      if verbose:
+         lnL = -0.5 * np.sum(np.log(2*np.pi/w)) - 0.5 * chi2
+         print('mean %.5g' %Y,' err', q, ' mlrms', wrms, lnL, ' rchi', chi2/n, rr, ' jit', s, s/wrms, wwrr,W)
       if -eps<rr-1<eps or s==0 or i>20:
          if ret_mean:
             return wrms, s, Y
@@ -3,5 +3,15 @@ import http.server
 import webbrowser
 
 PORT = 8000
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    def copyfile(self, source, outputfile):
+        # hand file bodies (e.g. the atmosphere tables) to the kernel;
+        # socket.sendfile falls back to send() for in-memory listings
+        self.connection.sendfile(source)
+
+
 webbrowser.open(f"http://localhost:{PORT}")
-http.server.test(HandlerClass=http.server.SimpleHTTPRequestHandler, port=PORT)
+http.server.test(HandlerClass=Handler, ServerClass=http.server.ThreadingHTTPServer,
+                 protocol="HTTP/1.1", port=PORT)